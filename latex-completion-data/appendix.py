@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from functools import lru_cache
 import util
 from typing import List, Dict, Optional
 
@@ -16,5 +17,17 @@ class Appendix:
     pass
 
 
-APPENDIX = util.load_json('data/appendix.json', Appendix)
-APPENDIX_MAP = {f.name: f for f in APPENDIX.components}
\ No newline at end of file
+@lru_cache(maxsize=None)
+def load_appendix():
+    return util.load_json('data/appendix.json', Appendix)
+
+
+@lru_cache(maxsize=None)
+def load_appendix_map():
+    return {f.name: f for f in load_appendix().components}
+
+
+__getattr__ = util.lazy_globals(globals(), {
+    'APPENDIX': load_appendix,
+    'APPENDIX_MAP': load_appendix_map,
+})
\ No newline at end of file
@@ -0,0 +1,64 @@
+from base64 import b64decode, b64encode
+from io import BytesIO
+from PIL import Image
+
+ATLAS_COLUMNS = 32
+ATLAS_ROWS = 32
+
+
+class Sprite:
+    def __init__(self, atlas, x, y, width, height):
+        self.atlas = atlas
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+
+def decode_image(data):
+    return Image.open(BytesIO(b64decode(data)))
+
+
+def encode_image(image):
+    buf = BytesIO()
+    image.save(buf, format='PNG')
+    return str(b64encode(buf.getvalue()), encoding='utf-8')
+
+
+def pack(images):
+    """Packs the images of an image table into a grid of sprite sheets.
+
+    Returns the encoded sheets and a table mapping every image id to its sprite.
+    """
+    decoded = {key: decode_image(data) for key, data in sorted(images.items())}
+    cell_width = max((image.width for image in decoded.values()), default=0)
+    cell_height = max((image.height for image in decoded.values()), default=0)
+    keys = list(decoded)
+    capacity = ATLAS_COLUMNS * ATLAS_ROWS
+    atlases = []
+    sprites = {}
+    for start in range(0, len(keys), capacity):
+        batch = keys[start:start + capacity]
+        columns = min(len(batch), ATLAS_COLUMNS)
+        rows = -(-len(batch) // ATLAS_COLUMNS)
+        sheet = Image.new('RGB', (columns * cell_width, rows * cell_height),
+                          (255, 255, 255))
+        for index, key in enumerate(batch):
+            image = decoded[key]
+            x = (index % ATLAS_COLUMNS) * cell_width
+            y = (index // ATLAS_COLUMNS) * cell_height
+            sheet.paste(image.convert('RGB'), (x, y))
+            sprites[key] = Sprite(len(atlases), x, y, image.width, image.height)
+        atlases.append(encode_image(sheet))
+    return atlases, sprites
+
+
+def unpack(atlases, sprites):
+    """Cuts the sprites out of their sheets again and returns a plain image table."""
+    sheets = [decode_image(data) for data in atlases]
+    images = {}
+    for key, sprite in sprites.items():
+        box = (sprite['x'], sprite['y'], sprite['x'] + sprite['width'],
+               sprite['y'] + sprite['height'])
+        images[key] = encode_image(sheets[sprite['atlas']].crop(box))
+    return images
@@ -0,0 +1,118 @@
+from argparse import ArgumentParser
+from base64 import b64encode
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from database import Database, Component, Command, CommandArgument, Metadata
+import export
+import json
+import jsons
+import mmap
+import random
+import time
+import tlpdb
+import tracemalloc
+
+
+def measure(desc, f):
+    tracemalloc.start()
+    start = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{desc:<24} {elapsed:8.3f} s {peak / 2 ** 20:10.1f} MiB peak')
+
+
+def generate_database(components, commands, image_size):
+    rng = random.Random(0)
+
+    def image():
+        if rng.random() < 0.5:
+            return None
+        return str(b64encode(bytes(rng.getrandbits(8) for _ in range(image_size))),
+                   encoding='utf-8')
+
+    database = Database()
+    for i in range(components):
+        cmds = []
+        for j in range(commands):
+            command = Command(f'cmd{i}x{j}')
+            command.image = image()
+            if j % 10 == 0:
+                command.parameters = [[CommandArgument(f'arg{k}', image())
+                                       for k in range(3)]]
+            cmds.append(command)
+        database.add_component(Component([f'package{i}.sty'], ['kernel.sty'],
+                                         cmds, [f'env{i}']))
+        database.metadata.append(Metadata(f'package{i}', 'Caption',
+                                          'A longer description.'))
+    return database
+
+
+def benchmark_json(args):
+    database = generate_database(args.components, args.commands,
+                                 args.image_size)
+    with TemporaryDirectory() as tmpdir:
+        jsons_path = Path(tmpdir) / 'jsons.json'
+        stream_path = Path(tmpdir) / 'stream.json'
+
+        def dump_jsons():
+            data = jsons.dump(database, key_transformer=jsons.KEY_TRANSFORMER_CAMELCASE,
+                              strip_privates=True)
+            jsons_path.write_text(json.dumps(
+                {key: value for key, value in data.items() if value is not None}))
+
+        measure('jsons.dumps', dump_jsons)
+        measure('export.save_as_json',
+                lambda: export.save_as_json(database, stream_path))
+        measure('export.save_as_json gz', lambda: export.save_as_json(
+            database, stream_path.with_suffix('.json.gz'), compression='gzip'))
+        if jsons_path.read_bytes() != stream_path.read_bytes():
+            raise SystemExit('The outputs differ.')
+
+
+def benchmark_tlpdb(args):
+    fields = tlpdb.DEFAULT_RECORD_FIELDS
+    result = {}
+
+    def parse_full():
+        with open(args.path) as f:
+            result['full'], _ = tlpdb.packages_from_tlpdb(f.readlines())
+
+    def parse_streaming():
+        with open(args.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            result['streaming'] = list(tlpdb.read_packages(data, fields))
+
+    measure('packages_from_tlpdb', parse_full)
+    measure('read_packages', parse_streaming)
+    full = [[getattr(x, field) for field in fields] for x in result['full']]
+    streaming = [[getattr(x, field) for field in fields]
+                 for x in result['streaming']]
+    if full != streaming:
+        raise SystemExit('The parsers disagree.')
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark parts of the pipeline.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    json_parser = subparsers.add_parser(
+        'json', help='compare jsons.dumps with the streaming JSON writer')
+    json_parser.add_argument('--components', type=int, default=500)
+    json_parser.add_argument('--commands', type=int, default=100)
+    json_parser.add_argument('--image-size', type=int, default=600)
+    json_parser.set_defaults(run=benchmark_json)
+
+    tlpdb_parser = subparsers.add_parser(
+        'tlpdb', help='compare the full tlpdb parser with the streaming one')
+    tlpdb_parser.add_argument('path', type=Path, help='path to texlive.tlpdb')
+    tlpdb_parser.set_defaults(run=benchmark_tlpdb)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
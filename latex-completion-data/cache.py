@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+CACHE_DIR = Path(os.environ.get(
+    'LATEX_COMPLETION_CACHE', Path(os.getcwd()) / '.cache'))
+
+
+def hash_bytes(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def hash_text(*parts):
+    return hash_bytes(*(part.encode('utf-8') for part in parts))
+
+
+@lru_cache(maxsize=None)
+def hash_file(path):
+    return hash_bytes(Path(path).read_bytes())
+
+
+def hash_files(paths):
+    """Fingerprint of the contents of several files; missing files count as empty."""
+    hashes = []
+    for path in sorted(str(path) for path in paths):
+        try:
+            hashes.append(f'{path}:{hash_file(path)}')
+        except OSError:
+            hashes.append(f'{path}:')
+    return hash_text(*hashes)
+
+
+class Cache:
+    extension = 'json'
+    errors = (OSError, ValueError)
+
+    def __init__(self, name):
+        self.dir = CACHE_DIR / name
+
+    def _path(self, key):
+        return self.dir / key[:2] / f'{key}.{self.extension}'
+
+    def _dumps(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def _loads(self, data):
+        return json.loads(data)
+
+    def get(self, key):
+        try:
+            return self._loads(self._path(key).read_bytes())
+        except self.errors:
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(
+            f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp_path.write_bytes(self._dumps(value))
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class PickleCache(Cache):
+    """Cache for arbitrary objects.
+
+    Pickles only refer to their classes by name. Entries whose classes were
+    removed or renamed are treated as missing, but callers have to put
+    anything else the objects depend on, like their fields, into the key.
+    """
+
+    extension = 'pickle'
+    errors = (OSError, EOFError, pickle.UnpicklingError,
+              AttributeError, ImportError)
+
+    def _dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, data):
+        return pickle.loads(data)
@@ -1,47 +1,169 @@
-import os
+import appendix
+import asyncio
+import json
 import tex
+import cache
 import re
 import logging
+import os
+import scheduler
+import time
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
 from tarjan import tarjan
+from tqdm import tqdm
 from subprocess import TimeoutExpired
 from database import Component, Command
-from util import with_progress
+from dataclasses import dataclass
 from pathlib import Path
-from appendix import APPENDIX_MAP
+from typing import Optional
+from interner import Interner
 
-FILE_REGEX = re.compile(r'\(([^\r\n()\s`]+\.(sty|cls))')
-CMD_REGEX = re.compile(r'^cmd:([a-zA-Z\*]+)$', re.MULTILINE)
+CMD_REGEX = re.compile(r'[a-zA-Z\*]+')
 COMPONENT_EXTS = ['.cls', '.sty']
+PACKAGE_CACHE = cache.Cache('packages')
+INPUT_CACHE = cache.Cache('package-inputs')
+FAILURE_CACHE = cache.Cache('failures')
+ANALYSIS_TIMEOUT = 10
+RETRY_TIMEOUT = 2
+NAMES = Interner()
+
+GRAPH_PATH = cache.CACHE_DIR / 'graph.json'
+HUB_MIN_DEPENDENTS = 25
+HUB_LIMIT = 8
+
+BASELINE_FORMAT_CODE = r'''\directlua{
+    local names = {"analysisbaseline", "analysisdump"}
+    for _, p in pairs(tex.primitives()) do
+        table.insert(names, p)
+    end
+
+    for _, v in pairs(tex.hashtokens()) do
+        local token = token.create(v)
+        if token then
+            table.insert(names, token.csname)
+        end
+    end
+
+    local baseline = table.concat(names, string.char(10))
+    local register = luatexbase.new_bytecode("baseline")
+    lua.bytecode[register] = load("return [==[" .. baseline .. "]==]")
+    token.set_macro("analysisbaseline", tostring(register), "global")
+    tex.enableprimitives("analysis", {"dump"})
+}
+\analysisdump
+'''
+
+
+class AnalysisError(Exception):
+    pass
+
+
+@dataclass
+class AnalysisOptions:
+    fmt_file: Optional[Path] = None
+    fmt_fingerprint: str = ''
+    engines: Optional[tex.EnginePool] = None
+    lean: bool = False
+    hub: Optional[str] = None
 
 
 class LatexPackage:
-    def __init__(self, file, refs, cmds, envs):
+    """The result of loading a single file; cmds and envs are bitsets over NAMES.
+
+    compiled tells whether the result was computed rather than taken from the cache.
+    """
+
+    def __init__(self, file, refs, cmds, envs, compiled=False):
         self.file = file
         self.refs = refs
         self.cmds = cmds
         self.envs = envs
+        self.compiled = compiled
 
     @staticmethod
-    def load(file):
-        code = LatexPackage._build_testcode(file)
-        result = tex.compile(code, fmt=tex.Format.LUALATEX)
-
-        log = result.read_log()
-        includes = (Path(match[0]) for match in FILE_REGEX.findall(log))
-        refs = [f for f in includes if f != file and f.name != 'minimal.cls']
-        cmds = {match for match in CMD_REGEX.findall(log)}
+    def cache_key(file, options=AnalysisOptions()):
+        """Returns the key of the file's result, given the inputs recorded by its last run."""
+        code = LatexPackage._build_testcode(file, options)
+        base_key = LatexPackage._base_key(file, options, code)
+        inputs = INPUT_CACHE.get(base_key) or []
+        return cache.hash_text(base_key, cache.hash_files(inputs))
+
+    @staticmethod
+    def _base_key(file, options, code):
+        return cache.hash_text(cache.hash_file(file),
+                               tex.engine_version(tex.Format.LUALATEX), code,
+                               LatexPackage._format_fingerprint(file, options))
+
+    @staticmethod
+    def load(file, options=AnalysisOptions(), timeout=ANALYSIS_TIMEOUT):
+        code = LatexPackage._build_testcode(file, options)
+        # The result also depends on every file that was loaded, so the key
+        # includes the contents of the inputs recorded by the previous run.
+        base_key = LatexPackage._base_key(file, options, code)
+        inputs = INPUT_CACHE.get(base_key) or []
+        entry = PACKAGE_CACHE.get(cache.hash_text(base_key, cache.hash_files(inputs)))
+        compiled = entry is None
+        if compiled:
+            if file.suffix == '.cls':
+                result = tex.compile(code, fmt=tex.Format.LUALATEX,
+                                     timeout=timeout, recorder=True)
+            elif options.engines is not None:
+                result = options.engines.run(file.stem, timeout)
+            else:
+                result = tex.compile(code, fmt=tex.Format.LUALATEX, timeout=timeout,
+                                     fmt_file=options.fmt_file, recorder=True)
+            entry = LatexPackage._read_result(file, result)
+            # Failed runs record their inputs too, so that the failure is
+            # keyed by the files it depends on.
+            inputs = result.read_inputs()
+            INPUT_CACHE.put(base_key, inputs)
+            if result.returncode != 0 and not entry['cmds']:
+                raise AnalysisError(f'exit code {result.returncode}')
+
+            PACKAGE_CACHE.put(cache.hash_text(base_key, cache.hash_files(inputs)), entry)
+
+        refs = [Path(ref) for ref in entry['refs']]
+        cmds = set(entry['cmds'])
         envs = {cmd for cmd in cmds if f'end{cmd}' in cmds}
 
-        if file.name in APPENDIX_MAP.keys():
-            cmds.update(APPENDIX_MAP[file.name].commands)
-            envs.update(APPENDIX_MAP[file.name].environments)
+        appendix_component = appendix.APPENDIX_MAP.get(file.name)
+        if appendix_component is not None:
+            cmds.update(appendix_component.commands)
+            envs.update(appendix_component.environments)
 
-        return LatexPackage(file, refs, cmds, envs)
+        return LatexPackage(file, refs, NAMES.encode(cmds), NAMES.encode(envs), compiled)
 
     @staticmethod
-    def _build_testcode(file):
+    def _format_fingerprint(file, options):
+        fingerprint = ''
+        fmt_file = tex.format_file(tex.Format.LUALATEX)
+        if fmt_file is not None:
+            fingerprint = cache.hash_file(fmt_file)
+        if options.fmt_file is not None and file.suffix != '.cls':
+            fingerprint = cache.hash_text(fingerprint, options.fmt_fingerprint)
+        return fingerprint
+
+    @staticmethod
+    def _read_result(file, result):
+        refs = []
+        cmds = set()
+        try:
+            with result.find('analysis').open(errors='replace') as f:
+                for line in f:
+                    kind, _, name = line.rstrip('\n').partition(':')
+                    if kind == 'cmd' and CMD_REGEX.fullmatch(name):
+                        cmds.add(name)
+                    elif kind == 'file' and name not in (file.name, 'minimal.cls'):
+                        ref = tex.FILE_RESOLVER.resolve(name)
+                        if ref is not None and ref.suffix in COMPONENT_EXTS:
+                            refs.append(ref)
+        except FileNotFoundError:
+            pass
+        return {'refs': [str(ref) for ref in refs], 'cmds': sorted(cmds)}
+
+    @staticmethod
+    def _build_testcode(file, options):
         code = ''
         if file.suffix == '.cls':
             code += f'\\documentclass{{{file.stem}}}\n'
@@ -53,8 +175,39 @@ class LatexPackage:
                         }
                     '''
         else:
-            code += '\\documentclass{minimal}\n'
-            code += r'''\directlua{
+            if options.hub:
+                code += f'% hub: {options.hub}\n'
+            code += LatexPackage._build_baseline(options.fmt_file is not None)
+            code += f'\\usepackage{{{file.stem}}}\n'
+        code += LatexPackage._build_listing(options.lean)
+        return code
+
+    @staticmethod
+    def _build_worker_code(options):
+        code = LatexPackage._build_baseline(options.fmt_file is not None)
+        code += r'''\directlua{
+                        primitives["analysisfile"] = true
+                        token.set_macro("analysisfile", io.read("*l"))
+                    }
+                '''
+        code += '\\expandafter\\usepackage\\expandafter{\\analysisfile}\n'
+        code += LatexPackage._build_listing(options.lean)
+        return code
+
+    @staticmethod
+    def _build_baseline(preloaded):
+        if preloaded:
+            return r'''\directlua{
+                            primitives = {}
+                            local register = tonumber(token.get_macro("analysisbaseline"))
+                            local baseline = lua.bytecode[register]()
+                            for name in string.gmatch(baseline, "[^" .. string.char(10) .. "]+") do
+                                primitives[name] = true
+                            end
+                        }
+                    '''
+
+        return '\\documentclass{minimal}\n' + r'''\directlua{
                             primitives = {}
                             for _, p in pairs(tex.primitives()) do
                                 primitives[p] = true
@@ -68,56 +221,287 @@ class LatexPackage:
                             end
                         }
                     '''
-            code += f'\\usepackage{{{file.stem}}}\n'
-        code += r'''\begin{document}
-                        \directlua{
-                            for i, v in pairs(tex.hashtokens()) do
-                                local token = token.create(v)
-                                if token and not primitives[token.csname] then
-                                    texio.write_nl("cmd:" .. token.csname)
-                                end
+
+    @staticmethod
+    def _build_listing(lean):
+        # \document resets \@filelist unless \listfiles was given, so the
+        # loaded files have to be listed in the preamble. The output does not
+        # use .idx, which \makeindex in the package under test would clobber.
+        files = r'''\directlua{
+                        local out = io.open(tex.jobname .. ".analysis", "w")
+                        for name in string.gmatch(token.get_macro("@filelist") or "", "[^,]+") do
+                            out:write("file:", name, string.char(10))
+                        end
+                        out:close()
+                    }
+                '''
+        cmds = r'''\directlua{
+                        local nl = string.char(10)
+                        local out = io.open(tex.jobname .. ".analysis", "a")
+                        for i, v in pairs(tex.hashtokens()) do
+                            local token = token.create(v)
+                            if token and not primitives[token.csname] then
+                                out:write("cmd:", token.csname, nl)
                             end
-                            texio.write_nl("")
-                        }
-                    \end{document}
+                        end
+                        out:close()
+                    }
                 '''
-        return code
+        if lean:
+            return files + cmds + '\\csname @@end\\endcsname\n'
+        return files + '\\begin{document}\n' + cmds + '\\end{document}\n'
+
+
+def dump_baseline_format(hub=None):
+    code = '\\documentclass{minimal}\n'
+    if hub:
+        code += f'\\usepackage{{{Path(hub).stem}}}\n'
+    code += BASELINE_FORMAT_CODE
+
+    try:
+        result = tex.dump_format(code, fmt=tex.Format.LUALATEX, recorder=True)
+    except TimeoutExpired:
+        result = None
+
+    if result is None or not result.find('fmt').exists():
+        logging.warning(f'Could not dump the baseline format ({hub}).')
+        return None
+    return result
+
+
+def format_fingerprint(result):
+    """Identifies a dumped format by its code and inputs, since the file itself differs between runs."""
+    return cache.hash_text(result.find('tex').read_text(),
+                           cache.hash_files(result.read_inputs()))
 
 
-def analyze(pkgs_by_name, file):
-    pkgs_by_name[file.name] = LatexPackage(file, [], set(), set())
+def load_graph():
     try:
-        pkgs_by_name[file.name] = LatexPackage.load(file)
+        return json.loads(GRAPH_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_graph(pkgs_by_name):
+    graph = {name: [ref.name for ref in pkg.refs]
+             for name, pkg in pkgs_by_name.items()}
+    GRAPH_PATH.parent.mkdir(parents=True, exist_ok=True)
+    GRAPH_PATH.write_text(json.dumps(graph, sort_keys=True))
+
+
+def find_hubs(graph):
+    dependents = Counter(ref for refs in graph.values()
+                         for ref in set(refs) if ref.endswith('.sty'))
+    return [name for name, count in dependents.most_common(HUB_LIMIT)
+            if count >= HUB_MIN_DEPENDENTS]
+
+
+def select_hub(graph, hubs, file):
+    if file.suffix != '.sty':
+        return None
+
+    candidates = [ref for ref in graph.get(file.name, []) if ref in hubs]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda hub: len(graph.get(hub, [])))
+
+
+def analyze(options, file):
+    # Failures are keyed like results, so a change to the file or to anything
+    # it loaded earns a retry with the full timeout.
+    # ls-R may still list files that were removed or cannot be read.
+    try:
+        key = LatexPackage.cache_key(file, options)
+    except OSError as error:
+        logging.warn(f'Could not read {file} ({error.strerror}).')
+        return LatexPackage(file, [], 0, 0)
+
+    failure = FAILURE_CACHE.get(key)
+    timeout = RETRY_TIMEOUT if failure else ANALYSIS_TIMEOUT
+
+    start = time.monotonic()
+    try:
+        package = LatexPackage.load(file, options, timeout)
+        if failure:
+            FAILURE_CACHE.delete(key)
+        return package
     except TimeoutExpired:
-        logging.warn(f'Could not analyze {file}.')
+        reason = 'timeout'
+    except AnalysisError as error:
+        reason = str(error)
+    except OSError as error:
+        reason = error.strerror or str(error)
+
+    elapsed = time.monotonic() - start
+    try:
+        # The failed run may have recorded other inputs.
+        key = LatexPackage.cache_key(file, options)
+    except OSError:
+        pass
+    FAILURE_CACHE.put(key, {'reason': reason, 'elapsed': elapsed})
+    logging.warn(f'Could not analyze {file} ({reason}).')
+    return LatexPackage(file, [], 0, 0)
+
+
+async def index_packages(pkgs_by_name, task, files, workers, min_free_memory):
+    history = scheduler.DurationHistory(cache.CACHE_DIR / 'durations.json')
+    # Cache hits and failures say nothing about how long a package takes.
+    jobs = scheduler.Scheduler(task, history, key=lambda file: file.name,
+                               timed=lambda pkg: pkg.compiled,
+                               workers=workers, min_free_memory=min_free_memory)
+    with tqdm(desc='Indexing packages', total=len(files)) as pbar:
+        async for pkg in jobs.run(files):
+            pkgs_by_name[pkg.file.name] = pkg
+            pbar.set_postfix(queued=jobs.queued, running=jobs.running,
+                             refresh=False)
+            pbar.update()
 
 
-def generate_database():
+def find_stale_files(components, changed_files, owners):
+    """Returns the changed files and, transitively, every file whose component references one of them.
+
+    Files without an owning TeX Live package (TEXMFLOCAL, TEXMFHOME) are
+    always treated as changed; the package cache still skips them if their
+    contents did not change.
+    """
+    components = [c for c in components if c.file_names]
+    dependents = {}
+    for component in components:
+        for ref in component.references:
+            dependents.setdefault(ref, []).append(component)
+
+    stale = {name for component in components for name in component.file_names
+             if name in changed_files or name not in owners}
+    stale |= set(changed_files)
+    pending = list(stale)
+    while pending:
+        for component in dependents.get(pending.pop(), []):
+            for name in component.file_names:
+                if name not in stale:
+                    stale.add(name)
+                    pending.append(name)
+    return stale
+
+
+def reuse_packages(previous, stale_files):
+    components = [c for c in previous.components if c.file_names]
+    components_by_name = {name: c for c in components for name in c.file_names}
+    closures = {}
+
+    def closure(component):
+        if id(component) in closures:
+            return closures[id(component)]
+
+        closures[id(component)] = (0, 0)
+        cmds = NAMES.encode(cmd.name for cmd in component.commands)
+        envs = NAMES.encode(component.environments)
+        for ref in component.references:
+            ref_component = components_by_name.get(ref)
+            if ref_component is not None and ref_component is not component:
+                ref_cmds, ref_envs = closure(ref_component)
+                cmds |= ref_cmds
+                envs |= ref_envs
+        closures[id(component)] = (cmds, envs)
+        return cmds, envs
+
+    resolve = tex.FILE_RESOLVER.resolve
     pkgs_by_name = {}
-    files = [f for f in tex.FILE_RESOLVER.files_by_name.values()
-             if f.suffix in COMPONENT_EXTS]
+    for name, component in components_by_name.items():
+        file = resolve(name)
+        if name in stale_files or file is None:
+            continue
+
+        cmds, envs = closure(component)
+        refs = [ref for ref in map(resolve, component.references)
+                if ref is not None]
+        pkgs_by_name[name] = LatexPackage(file, refs, cmds, envs)
+    return pkgs_by_name
+
+
+def dump_hub_formats(hubs):
+    with ThreadPoolExecutor(len(hubs) or 1) as executor:
+        results = zip(hubs, executor.map(dump_baseline_format, hubs))
+        return {hub: result for hub, result in results if result is not None}
+
+
+def generate_database(reused_pkgs=None, preload_format=False, warm_engines=False,
+                      lean=False, hub_formats=False, workers=None, min_free_memory=None):
+    pkgs_by_name = dict(reused_pkgs or {})
+    files = [tex.FILE_RESOLVER.resolve(name) for name in tex.FILE_RESOLVER.paths_by_name
+             if os.path.splitext(name)[1] in COMPONENT_EXTS and name not in pkgs_by_name]
 
-    with ThreadPoolExecutor(os.cpu_count()) as executor:
-        task = with_progress('Indexing packages', len(
-            files), partial(analyze, pkgs_by_name))
-        executor.map(task, files)
+    options = AnalysisOptions(lean=lean)
+    baseline = dump_baseline_format() if preload_format else None
+    if baseline is not None:
+        options.fmt_file = baseline.find('fmt')
+        options.fmt_fingerprint = format_fingerprint(baseline)
 
-    dep_graph = {pkg.file: [ref for ref in pkg.refs]
-                 for pkg in pkgs_by_name.values()}
+    if warm_engines:
+        # Every worker starts the engine for its next package while the
+        # current one runs, so it counts twice against the number of jobs.
+        workers = max(1, (workers or os.cpu_count()) // 2)
+        code = LatexPackage._build_worker_code(options)
+        options.engines = tex.EnginePool(code, fmt=tex.Format.LUALATEX,
+                                         fmt_file=options.fmt_file, recorder=True)
+
+    graph = load_graph()
+    hubs = dump_hub_formats(find_hubs(graph)) if hub_formats else {}
+    # The fingerprint covers every file read while dumping, including the hub itself.
+    hub_options = {hub: AnalysisOptions(fmt_file=result.find('fmt'), lean=lean, hub=hub,
+                                        fmt_fingerprint=format_fingerprint(result))
+                   for hub, result in hubs.items()}
+
+    def task(file):
+        hub = select_hub(graph, hub_options, file)
+        return analyze(hub_options[hub] if hub else options, file)
+
+    asyncio.run(index_packages(pkgs_by_name, task, files,
+                               workers, min_free_memory))
+    save_graph(pkgs_by_name)
+
+    if options.engines is not None:
+        options.engines.close()
+
+    return build_components(pkgs_by_name)
+
+
+def build_components(pkgs_by_name):
+    dep_graph = {name: [ref.name for ref in pkg.refs if ref.name in pkgs_by_name]
+                 for name, pkg in pkgs_by_name.items()}
+    kernel_cmds = NAMES.encode(tex.KERNEL_PRIMITIVES.commands)
+    kernel_envs = NAMES.encode(tex.KERNEL_PRIMITIVES.environments)
+
+    # tarjan emits a strongly connected component only after every component
+    # reachable from it, so the closures of all references are already known.
+    sccs = tarjan(dep_graph)
+    index_by_name = {name: index for index, names in enumerate(sccs)
+                     for name in names}
+    closures = []
 
     components = []
-    for component_files in tarjan(dep_graph):
-        pkg = pkgs_by_name[component_files[0].name]
-        names = [file.name for file in component_files]
-        refs = [ref.name for ref in pkg.refs]
-
-        for ref in (pkgs_by_name[ref.name] for ref in pkg.refs):
-            pkg.cmds.difference_update(ref.cmds)
-            pkg.envs.difference_update(ref.envs)
-        pkg.cmds.difference_update(tex.KERNEL_PRIMITIVES.commands)
-        pkg.envs.difference_update(tex.KERNEL_PRIMITIVES.environments)
-
-        cmds = [Command(cmd) for cmd in sorted(pkg.cmds)]
-        envs = sorted(pkg.envs)
+    for index, names in enumerate(sccs):
+        pkgs = [pkgs_by_name[name] for name in names]
+        ref_indices = {index_by_name[ref] for name in names
+                       for ref in dep_graph[name]}
+        ref_indices.discard(index)
+
+        inherited_cmds = 0
+        inherited_envs = 0
+        for ref_index in ref_indices:
+            inherited_cmds |= closures[ref_index][0]
+            inherited_envs |= closures[ref_index][1]
+
+        pkg_cmds = 0
+        pkg_envs = 0
+        for pkg in pkgs:
+            pkg_cmds |= pkg.cmds
+            pkg_envs |= pkg.envs
+        closures.append((pkg_cmds | inherited_cmds, pkg_envs | inherited_envs))
+
+        refs = [ref.name for ref in pkgs[0].refs]
+        own_cmds = pkg_cmds & ~(inherited_cmds | kernel_cmds)
+        own_envs = pkg_envs & ~(inherited_envs | kernel_envs)
+        cmds = [Command(cmd) for cmd in sorted(NAMES.decode(own_cmds))]
+        envs = sorted(NAMES.decode(own_envs))
         components.append(Component(names, refs, cmds, envs))
     return components
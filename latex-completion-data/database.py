@@ -1,17 +1,102 @@
+import atlas
+import cache
+import gzip
+import json
+
+IMAGE_ID_LENGTH = 16
+
+
 class Database:
+    """Components are indexed by file name and (component, command name) when they are added.
+
+    Components must be complete when they are added; commands appended later
+    are not indexed.
+    """
+
     def __init__(self):
         self.components = []
         self.metadata = []
+        self.images = None
+        self.atlases = None
+        self._components_by_file = {}
+        self._commands = {}
+
+    @staticmethod
+    def load(path):
+        if path.suffix == '.gz':
+            with gzip.open(str(path), 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        else:
+            data = json.loads(path.read_text())
+        database = Database()
+        database.add_components(Component.from_json(x)
+                                for x in data['components'])
+        database.metadata = [Metadata(x['name'], x['caption'], x['description'])
+                             for x in data['metadata']]
+        images = data.get('images')
+        if data.get('atlases') is not None:
+            images = atlas.unpack(data['atlases'], images)
+        if images is not None:
+            for owner in database._image_owners():
+                if owner.image is not None:
+                    owner.image = images[owner.image]
+        return database
+
+    def add_component(self, component):
+        self.components.append(component)
+        for file_name in component.file_names or [None]:
+            self._components_by_file.setdefault(file_name, component)
+        for command in component.commands:
+            self._commands.setdefault((component, command.name), command)
+
+    def add_components(self, components):
+        for component in components:
+            self.add_component(component)
 
     def find_package(self, name):
+        return self._components_by_file.get(name + '.sty' if name else None)
+
+    def find_command(self, component, name):
+        return self._commands.get((component, name))
+
+    def merge_commands(self, package_name, commands, attributes=('image', 'glyph', 'parameters')):
+        """Copies the given attributes of commands onto the commands of the same name in a package.
+
+        Returns False if the package is not part of the database.
+        """
+        component = self.find_package(package_name)
+        if component is None:
+            return False
+
+        for src_command in commands:
+            dst_command = self.find_command(component, src_command.name)
+            if dst_command is not None:
+                for attribute in attributes:
+                    setattr(dst_command, attribute,
+                            getattr(src_command, attribute))
+        return True
+
+    def deduplicate_images(self):
+        """Moves all images into a table keyed by a hash of their content and refers to them by that key."""
+        self.images = {}
+        for owner in self._image_owners():
+            if owner.image is not None:
+                key = cache.hash_text(owner.image)[:IMAGE_ID_LENGTH]
+                self.images.setdefault(key, owner.image)
+                owner.image = key
+
+    def pack_images(self):
+        """Replaces the image table by sprite sheets and the position of every image on them."""
+        if self.images is None:
+            self.deduplicate_images()
+        self.atlases, self.images = atlas.pack(self.images)
+
+    def _image_owners(self):
         for component in self.components:
-            if name:
-                file_name = name + '.sty'
-                if file_name in component.file_names:
-                    return component
-            else:
-                if component.file_names == []:
-                    return component
+            for command in component.commands:
+                yield command
+                for parameter in command.parameters:
+                    yield from parameter
 
 
 class Component:
@@ -22,6 +107,12 @@ class Component:
         self.environments = environments
         pass
 
+    @staticmethod
+    def from_json(data):
+        commands = [Command.from_json(x) for x in data['commands']]
+        return Component(data['fileNames'], data['references'], commands,
+                         data['environments'])
+
 
 class Command:
     def __init__(self, name):
@@ -31,6 +122,22 @@ class Command:
         self.parameters = []
         pass
 
+    @staticmethod
+    def from_json(data):
+        command = Command(data['name'])
+        command.image = data['image']
+        command.glyph = data['glyph']
+        command.parameters = [[CommandArgument(x['name'], x['image'])
+                               for x in parameter]
+                              for parameter in data['parameters']]
+        return command
+
+
+class CommandArgument:
+    def __init__(self, name, image):
+        self.name = name
+        self.image = image
+
 
 class Metadata:
     def __init__(self, name, caption, description):
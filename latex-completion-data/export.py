@@ -0,0 +1,173 @@
+from base64 import b64decode
+import gzip
+import io
+import json
+import os
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE components (id INTEGER PRIMARY KEY);
+CREATE TABLE component_files (component_id INTEGER NOT NULL REFERENCES components, name TEXT);
+CREATE TABLE component_references (component_id INTEGER NOT NULL REFERENCES components, name TEXT NOT NULL);
+CREATE TABLE images (id INTEGER PRIMARY KEY, data BLOB NOT NULL UNIQUE);
+CREATE TABLE commands (
+    id INTEGER PRIMARY KEY,
+    component_id INTEGER NOT NULL REFERENCES components,
+    name TEXT NOT NULL,
+    image_id INTEGER REFERENCES images,
+    glyph TEXT
+);
+CREATE TABLE command_arguments (
+    command_id INTEGER NOT NULL REFERENCES commands,
+    parameter INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    image_id INTEGER REFERENCES images
+);
+CREATE TABLE environments (component_id INTEGER NOT NULL REFERENCES components, name TEXT NOT NULL);
+CREATE TABLE metadata (name TEXT NOT NULL, caption TEXT, description TEXT);
+'''
+
+# Created after the data is inserted, which is considerably faster than
+# maintaining them during the import. Name lookups by prefix can use these
+# indexes with `name GLOB 'prefix*'` or `name >= ? AND name < ?`.
+INDEXES = '''
+CREATE INDEX component_files_name ON component_files (name);
+CREATE INDEX component_files_component ON component_files (component_id);
+CREATE INDEX component_references_component ON component_references (component_id);
+CREATE INDEX commands_name ON commands (name);
+CREATE INDEX commands_component ON commands (component_id);
+CREATE INDEX command_arguments_command ON command_arguments (command_id);
+CREATE INDEX environments_name ON environments (name);
+CREATE INDEX environments_component ON environments (component_id);
+CREATE INDEX metadata_name ON metadata (name);
+'''
+
+
+class ImageTable:
+    def __init__(self, conn, images=None):
+        self.conn = conn
+        self.images = images
+        self.ids = {}
+
+    def insert(self, image):
+        if image is None:
+            return None
+        if self.images is not None:
+            image = self.images[image]
+
+        image_id = self.ids.get(image)
+        if image_id is None:
+            image_id = len(self.ids) + 1
+            self.ids[image] = image_id
+            self.conn.execute('INSERT INTO images VALUES (?, ?)',
+                              (image_id, b64decode(image)))
+        return image_id
+
+
+def save_as_sqlite(database, path):
+    """Writes the database into a normalized SQLite file, replacing an existing file at path.
+
+    Images are stored once as PNG blobs. The database must not have been
+    packed into sprite sheets.
+    """
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    conn = sqlite3.connect(str(tmp_path))
+    try:
+        with conn:
+            conn.executescript(SCHEMA)
+            images = ImageTable(conn, database.images)
+            command_id = 0
+            for component_id, component in enumerate(database.components, start=1):
+                conn.execute('INSERT INTO components VALUES (?)',
+                             (component_id,))
+                conn.executemany('INSERT INTO component_files VALUES (?, ?)',
+                                 ((component_id, x) for x in component.file_names or [None]))
+                conn.executemany('INSERT INTO component_references VALUES (?, ?)',
+                                 ((component_id, x) for x in component.references))
+                conn.executemany('INSERT INTO environments VALUES (?, ?)',
+                                 ((component_id, x) for x in component.environments))
+                for command in component.commands:
+                    command_id += 1
+                    conn.execute('INSERT INTO commands VALUES (?, ?, ?, ?, ?)',
+                                 (command_id, component_id, command.name,
+                                  images.insert(command.image), command.glyph))
+                    for index, parameter in enumerate(command.parameters):
+                        for position, argument in enumerate(parameter):
+                            conn.execute('INSERT INTO command_arguments VALUES (?, ?, ?, ?, ?)',
+                                         (command_id, index, position, argument.name,
+                                          images.insert(argument.image)))
+
+            conn.executemany('INSERT INTO metadata VALUES (?, ?, ?)',
+                             ((x.name, x.caption, x.description)
+                              for x in database.metadata))
+            conn.executescript(INDEXES)
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+
+def _camelcase(name):
+    # Same transformation as jsons.KEY_TRANSFORMER_CAMELCASE.
+    parts = name.replace('-', '_').split('_')
+    if len(parts) > 1:
+        name = ''.join(part.title() for part in parts)
+    return name[0].lower() + name[1:]
+
+
+def _public_attributes(obj, strip_nulls=False):
+    # jsons orders the attributes of an object by name and transforms the
+    # keys of nested dicts as well.
+    for name in sorted(vars(obj)):
+        if not name.startswith('_'):
+            value = getattr(obj, name)
+            if value is None and strip_nulls:
+                continue
+            if isinstance(value, dict):
+                value = {_camelcase(key): x for key, x in value.items()}
+            yield _camelcase(name), value
+
+
+def _to_json(obj):
+    return dict(_public_attributes(obj))
+
+
+def _dumps(value):
+    return json.dumps(value, default=_to_json)
+
+
+def _open_text(path, compression):
+    if compression == 'gzip':
+        # A fixed timestamp keeps the output reproducible.
+        return io.TextIOWrapper(gzip.GzipFile(str(path), 'wb', mtime=0),
+                                encoding='utf-8')
+    return path.open('w', encoding='utf-8')
+
+
+def save_as_json(database, path, compression=None):
+    """Writes the database as JSON, one list element at a time.
+
+    Top-level attributes that are None (images and atlases unless they were
+    requested) are left out. Otherwise, the output is byte-identical to
+    jsons.dumps(database, key_transformer=KEY_TRANSFORMER_CAMELCASE, strip_privates=True).
+    """
+    with _open_text(path, compression) as f:
+        f.write('{')
+        for index, (key, value) in enumerate(_public_attributes(database, strip_nulls=True)):
+            if index > 0:
+                f.write(', ')
+            f.write(_dumps(key))
+            f.write(': ')
+            if isinstance(value, list):
+                f.write('[')
+                for item_index, item in enumerate(value):
+                    if item_index > 0:
+                        f.write(', ')
+                    f.write(_dumps(item))
+                f.write(']')
+            else:
+                f.write(_dumps(value))
+        f.write('}')
@@ -0,0 +1,45 @@
+import sys
+import threading
+
+
+class Interner:
+    """Assigns consecutive ids to names so that sets of names can be stored as bitsets.
+
+    A bitset is a plain int with bit i set if the name with index i is a member,
+    so union, intersection and difference are |, & and & ~.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.names = []
+
+    def _id(self, name):
+        index = self.ids.get(name)
+        if index is None:
+            index = len(self.names)
+            name = sys.intern(name)
+            self.ids[name] = index
+            self.names.append(name)
+        return index
+
+    def encode(self, names):
+        with self.lock:
+            ids = [self._id(name) for name in names]
+        if not ids:
+            return 0
+
+        bits = bytearray(max(ids) // 8 + 1)
+        for index in ids:
+            bits[index >> 3] |= 1 << (index & 7)
+        return int.from_bytes(bits, 'little')
+
+    def decode(self, bitset):
+        data = bitset.to_bytes((bitset.bit_length() + 7) // 8, 'little')
+        names = []
+        for offset, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                names.append(self.names[offset * 8 + low.bit_length() - 1])
+                byte ^= low
+        return names
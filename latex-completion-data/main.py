@@ -1,45 +1,122 @@
+from argparse import ArgumentParser
 from pathlib import Path
-from jsons import KEY_TRANSFORMER_CAMELCASE
 from database import Database, Command, Component
+from manifest import Manifest, MANIFEST_FILE
 import logging
+import export
 import symbols
 import tex
 import util
 import components
 import metadata
 import os
-import jsons
+
+
+def merge_symbols(database, name, commands):
+    if not database.merge_commands(name, commands):
+        logging.error(f'Package {name} was not indexed but has symbols')
 
 
 def main():
+    parser = ArgumentParser(description='Generate the completion database.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only re-analyze TeX Live packages whose revision changed since the previous run')
+    parser.add_argument('--preload-format', action='store_true',
+                        help='analyze packages on top of a precompiled format with the kernel baseline')
+    parser.add_argument('--warm-engines', action='store_true',
+                        help='keep a started LuaLaTeX process per worker that receives the next package over a pipe')
+    parser.add_argument('--lean', action='store_true',
+                        help='list new commands right after loading a package and skip the document body')
+    parser.add_argument('--hub-formats', action='store_true',
+                        help='analyze dependents of frequently loaded packages on top of a format with that package')
+    parser.add_argument('--jobs', type=int,
+                        help='number of TeX processes to run concurrently (default: number of cores); '
+                             'with --warm-engines, every package needs two')
+    parser.add_argument('--memory-limit', type=int, default=tex.LIMITS.memory // 2 ** 20,
+                        help='address space limit of every TeX process in MiB (0 to disable)')
+    parser.add_argument('--min-free-memory', type=int, default=0,
+                        help='do not start new TeX processes while less memory is available (MiB)')
+    parser.add_argument('--symbol-renderer', default=symbols.Renderer.RASTER.value,
+                        choices=[renderer.value for renderer in symbols.Renderer],
+                        help='rasterize symbol pages at a fixed DPI or directly at the target size')
+    parser.add_argument('--symbol-svg-dir', type=Path,
+                        help='also export every symbol as SVG into this directory '
+                             '(renders all symbols again)')
+    parser.add_argument('--image-table', action='store_true',
+                        help='store every distinct symbol image once and refer to it by id')
+    parser.add_argument('--image-atlas', action='store_true',
+                        help='like --image-table, but pack the images into sprite sheets')
+    parser.add_argument('--sqlite', type=Path, metavar='PATH',
+                        help='also write the database as indexed SQLite file')
+    parser.add_argument('--gzip', action='store_true',
+                        help='write completion.json.gz instead of completion.json')
+    args = parser.parse_args()
+    tex.LIMITS.memory = args.memory_limit * 2 ** 20
+
     logging.basicConfig(format='%(levelname)-8s %(message)s',
                         level=logging.INFO, filename='latex-completion-data.log', filemode='w')
 
+    path = Path(os.getcwd()) / ('completion.json.gz' if args.gzip else 'completion.json')
+    manifest_path = Path(os.getcwd()) / MANIFEST_FILE
+    tl_store = metadata.load_package_store()
+    manifest = Manifest.from_store(tl_store)
+
+    previous = None
+    if args.incremental and path.exists() and manifest_path.exists():
+        previous = Database.load(path)
+        previous_manifest = Manifest.load(manifest_path)
+    elif args.incremental:
+        logging.warning('No previous database found, rebuilding everything.')
+
     database = Database()
-    database.components = components.generate_database()
-    database.components.append(Component([], [],
-                                         [Command(x)
-                                          for x in tex.KERNEL_PRIMITIVES.commands],
-                                         tex.KERNEL_PRIMITIVES.environments))
-
-    for src_package in symbols.SYMBOL_DATABASE.render():
-        dst_package = database.find_package(src_package.name)
-        if dst_package is None:
-            logging.error(
-                f'Package {src_package.name} was not indexed but has symbols')
-            continue
-
-        for src_command in src_package.commands:
-            for dst_command in dst_package.commands:
-                if src_command.name == dst_command.name:
-                    dst_command.image = src_command.image
-                    dst_command.glyph = src_command.glyph
-                    dst_command.parameters = src_command.parameters
-
-    database.metadata = metadata.extract()
-    json = jsons.dumps(database, key_transformer=KEY_TRANSFORMER_CAMELCASE)
-    path = Path(os.getcwd()) / 'completion.json'
-    path.write_text(json)
+    reused_pkgs = None
+    if previous is not None:
+        changes = manifest.diff(previous_manifest)
+        logging.info(f'{len(changes.files)} files changed since last run')
+        stale_files = components.find_stale_files(
+            previous.components, changes.files, manifest.owners)
+        logging.info(f'{len(stale_files)} files need to be analyzed again')
+        reused_pkgs = components.reuse_packages(previous, stale_files)
+    database.add_components(components.generate_database(
+        reused_pkgs, preload_format=args.preload_format, warm_engines=args.warm_engines,
+        lean=args.lean, hub_formats=args.hub_formats, workers=args.jobs,
+        min_free_memory=args.min_free_memory * 2 ** 20))
+
+    database.add_component(Component([], [],
+                                     [Command(x)
+                                      for x in tex.KERNEL_PRIMITIVES.commands],
+                                     tex.KERNEL_PRIMITIVES.environments))
+
+    symbol_packages = symbols.SYMBOL_DATABASE.packages
+    if previous is not None and args.symbol_svg_dir is None:
+        stale_packages = []
+        for package in symbol_packages:
+            if changes.affects_symbol_package(package.name) or \
+                    f'{package.name}.sty' in stale_files:
+                stale_packages.append(package)
+            else:
+                previous_package = previous.find_package(package.name)
+                if previous_package is not None:
+                    merge_symbols(database, package.name,
+                                  previous_package.commands)
+                else:
+                    stale_packages.append(package)
+        symbol_packages = stale_packages
+
+    rendered_packages = symbols.SYMBOL_DATABASE.render(
+        symbol_packages, renderer=symbols.Renderer(args.symbol_renderer), svg_dir=args.symbol_svg_dir)
+    for src_package in rendered_packages:
+        merge_symbols(database, src_package.name, src_package.commands)
+
+    database.metadata = metadata.extract(tl_store.packages())
+    if args.sqlite:
+        export.save_as_sqlite(database, args.sqlite)
+    if args.image_atlas:
+        database.pack_images()
+    elif args.image_table:
+        database.deduplicate_images()
+    export.save_as_json(database, path, compression='gzip' if args.gzip else None)
+    manifest.save(manifest_path)
     print()
 
 
@@ -0,0 +1,43 @@
+import json
+from components import COMPONENT_EXTS
+
+MANIFEST_FILE = 'completion.manifest.json'
+KERNEL_PACKAGE = 'latex'
+
+
+class Manifest:
+    def __init__(self, revisions, owners):
+        self.revisions = revisions
+        self.owners = owners
+
+    @staticmethod
+    def from_store(store):
+        return Manifest(store.revisions(), store.owners(COMPONENT_EXTS))
+
+    @staticmethod
+    def load(path):
+        data = json.loads(path.read_text())
+        return Manifest(data['revisions'], data['owners'])
+
+    def save(self, path):
+        data = {'revisions': self.revisions, 'owners': self.owners}
+        path.write_text(json.dumps(data, sort_keys=True))
+
+    def diff(self, previous):
+        packages = {name for name, revision in self.revisions.items()
+                    if previous.revisions.get(name) != revision}
+        files = {name for name, owner in self.owners.items()
+                 if owner in packages or previous.owners.get(name) != owner}
+        return Changes(packages, files)
+
+
+class Changes:
+    def __init__(self, packages, files):
+        self.packages = packages
+        self.files = files
+
+    def affects_symbol_package(self, name):
+        if name:
+            return name + '.sty' in self.files
+        else:
+            return KERNEL_PACKAGE in self.packages
@@ -2,7 +2,7 @@ from database import Metadata
 from pathlib import Path
 from components import COMPONENT_EXTS
 from tqdm import tqdm
-import requests
+from cache import CACHE_DIR
 import tlpdb
 from tex import find_root_dir
 
@@ -11,10 +11,12 @@ def is_valid_package(package):
     return not package.name.startswith('00') and package.shortdesc and package.longdesc
 
 
-def extract():
-    lines = open(find_root_dir().parent.as_posix() + "/tlpkg/texlive.tlpdb").readlines()
-    packages, _ = tlpdb.packages_from_tlpdb(lines)
+def load_package_store():
+    path = find_root_dir().parent / 'tlpkg' / 'texlive.tlpdb'
+    return tlpdb.PackageStore(path, CACHE_DIR / 'tlpdb.sqlite')
 
+
+def extract(packages):
     metadata = []
     for package in tqdm(filter(is_valid_package, packages), desc='Extracting metadata'):
         caption = package.shortdesc.strip()
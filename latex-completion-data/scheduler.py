@@ -0,0 +1,121 @@
+import asyncio
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+ADMISSION_INTERVAL = 0.5
+DURATION_SMOOTHING = 0.5
+
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class DurationHistory:
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.durations = json.loads(path.read_text())
+        except (OSError, ValueError):
+            self.durations = {}
+
+    def get(self, key):
+        return self.durations.get(key, math.inf)
+
+    def record(self, key, duration):
+        # A moving average follows packages that got faster, while a single
+        # slow run on a busy machine does not dominate the order for good.
+        previous = self.durations.get(key)
+        if previous is not None:
+            duration = (1 - DURATION_SMOOTHING) * previous + DURATION_SMOOTHING * duration
+        self.durations[key] = duration
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(self.durations, sort_keys=True))
+
+
+class Scheduler:
+    """Runs blocking jobs on a thread pool, starting with the ones that took longest in the past.
+
+    Jobs without a recorded duration are treated as the longest ones. Only
+    the durations of jobs whose result satisfies timed are recorded. If
+    min_free_memory is given, no new job is started while less memory is
+    available, unless nothing else is running.
+    """
+
+    def __init__(self, fn, history, key=str, timed=None, workers=None, min_free_memory=None):
+        self.fn = fn
+        self.history = history
+        self.key = key
+        self.timed = timed
+        self.workers = workers or os.cpu_count()
+        self.min_free_memory = min_free_memory
+        self.queue = None
+        self.running = 0
+
+    @property
+    def queued(self):
+        return self.queue.qsize() if self.queue else 0
+
+    def _is_memory_low(self):
+        if not self.min_free_memory:
+            return False
+        memory = available_memory()
+        return memory is not None and memory < self.min_free_memory
+
+    async def _admit(self):
+        while self.running > 0 and self._is_memory_low():
+            await asyncio.sleep(ADMISSION_INTERVAL)
+
+    async def run(self, jobs):
+        loop = asyncio.get_running_loop()
+        jobs = sorted(jobs, key=lambda x: self.history.get(self.key(x)),
+                      reverse=True)
+        self.queue = asyncio.Queue()
+        for job in jobs:
+            self.queue.put_nowait(job)
+
+        results = asyncio.Queue()
+        with ThreadPoolExecutor(self.workers) as executor:
+            async def work():
+                while True:
+                    await self._admit()
+                    if self.queue.empty():
+                        return
+
+                    job = self.queue.get_nowait()
+                    start = time.monotonic()
+                    self.running += 1
+                    try:
+                        result = await loop.run_in_executor(executor, self.fn, job)
+                        if self.timed is None or self.timed(result):
+                            self.history.record(self.key(job), time.monotonic() - start)
+                        await results.put((result, None))
+                    except Exception as error:
+                        await results.put((None, error))
+                    finally:
+                        self.running -= 1
+
+            workers = [asyncio.ensure_future(work())
+                       for _ in range(self.workers)]
+            try:
+                for _ in range(len(jobs)):
+                    result, error = await results.get()
+                    if error is not None:
+                        raise error
+                    yield result
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                self.history.save()
@@ -1,6 +1,8 @@
 from base64 import b64encode
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
+from enum import Enum
+from functools import lru_cache, partial
 from pathlib import Path
 from PIL import Image, ImageOps
 from io import BytesIO
@@ -8,18 +10,62 @@ from typing import List, Dict, Optional
 from util import with_progress
 import util
 import logging
+import cache
 import tex
 import base64
 import pdf2image
 import multiprocessing
+import re
+import subprocess
 
 
 SYMBOL_SIZE = (48, 48)
 SYMBOL_PADDING = 5
+RENDER_DPI = 3000
+RENDER_BATCH_SIZE = 8
+RENDER_CHUNK_SIZE = 64
+VECTOR_RENDER_SIZE = 4 * SYMBOL_SIZE[0]
+IMAGE_CACHE = cache.Cache('symbols')
+INPUT_CACHE = cache.Cache('symbol-inputs')
 
 
+class Renderer(Enum):
+    RASTER = 'raster'
+    VECTOR = 'vector'
+
+
+def render_pages(pdf_path, renderer, first_page, last_page):
+    # Runs in a worker process, so that cropping and encoding the images
+    # of different batches is not serialized by the GIL.
+    # standalone already crops every page to the bounding box of its
+    # symbol, so the vector renderer can rasterize pages directly at a
+    # small multiple of the target size instead of at a fixed DPI.
+    if renderer == Renderer.VECTOR:
+        options = {'size': VECTOR_RENDER_SIZE, 'use_pdftocairo': True}
+    else:
+        options = {'dpi': RENDER_DPI}
+
+    pages = pdf2image.convert_from_path(str(pdf_path), first_page=first_page,
+                                        last_page=last_page, **options)
+    return [postprocess_image(page) for page in pages]
+
+
+def postprocess_image(image):
+    image = image.crop(ImageOps.invert(image).getbbox())
+    image.thumbnail(SYMBOL_SIZE, Image.BILINEAR)
+    image = ImageOps.expand(image, SYMBOL_PADDING, (255, 255, 255))
+
+    buf = BytesIO()
+    image.save(buf, format='PNG')
+    return str(b64encode(buf.getvalue()), encoding='utf-8')
+
+
+@lru_cache(maxsize=None)
 def load_unicode_symbols():
-    file = Path(__file__).parent / 'data/unimathsymbols.txt'
+    return util.load_data('data/unimathsymbols.txt', _read_unicode_symbols)
+
+
+def _read_unicode_symbols(file):
     with file.open(encoding='utf-8') as f:
         lines = [l.strip().split('^') for l in f if not l.startswith('#')]
         symbols = {}
@@ -31,9 +77,6 @@ def load_unicode_symbols():
         return symbols
 
 
-UNICODE_SYMBOLS = load_unicode_symbols()
-
-
 @dataclass
 class UnrenderedSymbolCommandArgument:
     name: str
@@ -53,13 +96,8 @@ class UnrenderedSymbolPackage:
     font_encoding: str
     commands: List[UnrenderedSymbolCommand]
 
-    def render(self):
+    def assemble(self, images):
         rendered_package = SymbolPackage(self.name)
-        result = tex.compile(self._build_render_code(), timeout=60, pdf=True)
-        pdf_path = result.find('pdf')
-        images = [self._postprocess_image(img)
-                  for img in pdf2image.convert_from_path(str(pdf_path), dpi=3000)]
-
         image_index = 0
         for cmd in self.commands:
             cmd_image = None
@@ -67,7 +105,7 @@ class UnrenderedSymbolPackage:
                 cmd_image = images[image_index]
                 image_index += 1
 
-            glyph = UNICODE_SYMBOLS.get(cmd.name)
+            glyph = load_unicode_symbols().get(cmd.name)
             rendered_cmd = SymbolCommand(cmd.name, cmd_image, glyph)
             for parameter in cmd.parameters:
                 args = []
@@ -80,6 +118,49 @@ class UnrenderedSymbolPackage:
             rendered_package.commands.append(rendered_cmd)
         return rendered_package
 
+    def render_chunk(self, fragments, renderer, pool, svg_files=None):
+        """Returns the images of the fragments, or None if they cannot be told apart."""
+        code = self._build_render_code([code for _, code in fragments])
+        result = tex.compile(code, timeout=60, pdf=True, recorder=True)
+        pdf_path = result.find('pdf')
+        try:
+            page_count = pdf2image.pdfinfo_from_path(str(pdf_path))['Pages']
+        except pdf2image.exceptions.PDFPageCountError:
+            page_count = 0
+        # A fragment without a page would shift all following images.
+        if page_count != len(fragments):
+            logging.warning(f'Rendering {self.name or "kernel"} produced {page_count} '
+                            f'pages for {len(fragments)} symbols.')
+            return None, result.read_inputs()
+
+        batches = []
+        for first_page in range(1, len(fragments) + 1, RENDER_BATCH_SIZE):
+            last_page = min(first_page + RENDER_BATCH_SIZE - 1, len(fragments))
+            batches.append(pool.submit(render_pages, pdf_path, renderer,
+                                       first_page, last_page))
+        if svg_files:
+            self._export_svgs(pdf_path, svg_files)
+
+        images = [image for batch in batches for image in batch.result()]
+        return images, result.read_inputs()
+
+    def _inputs_key(self):
+        return cache.hash_text(self.name or '', self.font_encoding)
+
+    def _image_keys(self, fragments, renderer, inputs):
+        fingerprint = cache.hash_files(inputs)
+        return [cache.hash_text(self.name or '', self.font_encoding, code,
+                                renderer.value, fingerprint)
+                for _, code in fragments]
+
+    def _fragments(self):
+        for command in self.commands:
+            if command.code:
+                yield command.name, command.code
+            for index, parameter in enumerate(command.parameters):
+                for argument in parameter:
+                    yield f'{command.name}.{index}.{argument.name}', argument.code
+
     def _build_render_code_header(self, lines):
         lines.append(
             "\\documentclass[preview, varwidth,margin=3pt, multi=yes]{standalone}")
@@ -91,34 +172,31 @@ class UnrenderedSymbolPackage:
         if self.name:
             lines.append(f"\\usepackage{{{self.name}}}")
 
-    def _build_render_code(self):
-        def build_fragment(lines, code):
-            lines.append("\\begin{center}")
-            lines.append(code)
-            lines.append("\\end{center}")
-
+    def _build_render_code(self, codes):
         lines = []
         self._build_render_code_header(lines)
         lines.append("\\begin{document}")
-        for command in self.commands:
-            if command.code:
-                build_fragment(lines, command.code)
-
-            for parameter in command.parameters:
-                for argument in parameter:
-                    build_fragment(lines, argument.code)
+        for code in codes:
+            lines.append("\\begin{center}")
+            lines.append(code)
+            lines.append("\\end{center}")
 
         lines.append('\\end{document}')
         return '\n'.join(lines)
 
-    def _postprocess_image(self, image):
-        image = image.crop(ImageOps.invert(image).getbbox())
-        image.thumbnail(SYMBOL_SIZE, Image.BILINEAR)
-        image = ImageOps.expand(image, SYMBOL_PADDING, (255, 255, 255))
+    def _svg_file(self, svg_dir, index, name):
+        # Sanitized names collide (\{ and \} both become _), so the file name
+        # starts with the position of the fragment within the package.
+        file_name = '{:05d}-{}.svg'.format(index, re.sub(r'[^\w.-]', '_', name))
+        return Path(svg_dir) / (self.name or 'kernel') / file_name
 
-        buf = BytesIO()
-        image.save(buf, format='PNG')
-        return str(b64encode(buf.getvalue()), encoding='utf-8')
+    def _export_svgs(self, pdf_path, svg_files):
+        for page, svg_file in enumerate(svg_files, start=1):
+            svg_file.parent.mkdir(parents=True, exist_ok=True)
+            cmd = ['pdftocairo', '-svg', '-f', str(page), '-l', str(page),
+                   str(pdf_path), str(svg_file)]
+            subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
 
     def _count_symbols(self):
         count = 0
@@ -134,14 +212,97 @@ class UnrenderedSymbolPackage:
 class UnrenderedSymbolDatabase:
     packages: List[UnrenderedSymbolPackage]
 
-    def render(self):
-        with ThreadPoolExecutor(multiprocessing.cpu_count()) as executor:
-            task = with_progress('Rendering symbols', len(
-                self.packages), UnrenderedSymbolPackage.render)
-            return list(executor.map(task, self.packages))
-
-
-SYMBOL_DATABASE = util.load_json('data/symbols.json', UnrenderedSymbolDatabase)
+    def render(self, packages=None, renderer=Renderer.RASTER, svg_dir=None):
+        packages = self.packages if packages is None else packages
+        # The cache only holds the images, so exporting SVGs needs every
+        # fragment to be compiled again.
+        jobs = [SymbolRenderJob(package, renderer, use_cache=svg_dir is None)
+                for package in packages]
+        chunks = [(job, chunk) for job in jobs for chunk in job.chunks()]
+        chunks.sort(key=lambda x: len(x[1]), reverse=True)
+
+        def render_chunk(pool, chunk):
+            job, indices = chunk
+            job.render_chunk(indices, svg_dir, pool)
+
+        # The pool starts its workers lazily from the rendering threads, and
+        # forking a process that runs threads is unsafe.
+        mp_context = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(multiprocessing.cpu_count(), mp_context=mp_context) as pool, \
+                ThreadPoolExecutor(multiprocessing.cpu_count()) as executor:
+            task = with_progress('Rendering symbols', len(chunks),
+                                 partial(render_chunk, pool))
+            list(executor.map(task, chunks))
+        return [job.finish() for job in jobs]
+
+
+class SymbolRenderJob:
+    """Renders the fragments of a package that are not cached yet.
+
+    Images are cached by their code and a fingerprint of every file the
+    package has read so far (fonts, encodings, packages, the format). The set
+    of inputs only grows, and as long as none of them changes, previously
+    rendered images stay valid. The missing fragments are split into chunks
+    of similar size, which are compiled independently. Without use_cache,
+    every fragment counts as missing.
+    """
+
+    def __init__(self, package, renderer, use_cache=True):
+        self.package = package
+        self.renderer = renderer
+        self.fragments = list(package._fragments())
+        self.inputs = INPUT_CACHE.get(package._inputs_key()) or []
+        keys = package._image_keys(self.fragments, renderer, self.inputs)
+        self.images = [IMAGE_CACHE.get(key) if use_cache else None
+                       for key in keys]
+        self.missing = [i for i, image in enumerate(self.images)
+                        if image is None]
+        self.new_inputs = []
+
+    def chunks(self):
+        count = -(-len(self.missing) // RENDER_CHUNK_SIZE)
+        for i in range(count):
+            yield self.missing[i * len(self.missing) // count:
+                               (i + 1) * len(self.missing) // count]
+
+    def render_chunk(self, indices, svg_dir, pool):
+        svg_files = None
+        if svg_dir:
+            svg_files = [self.package._svg_file(svg_dir, i, self.fragments[i][0])
+                         for i in indices]
+        images, inputs = self.package.render_chunk(
+            [self.fragments[i] for i in indices], self.renderer, pool, svg_files)
+        if images is not None:
+            for i, image in zip(indices, images):
+                self.images[i] = image
+        self.new_inputs.append(inputs)
+
+    def finish(self):
+        missing = self.missing
+        new_inputs = {x: None for inputs in self.new_inputs for x in inputs
+                      if x not in self.inputs}
+        if new_inputs:
+            self.inputs = self.inputs + list(new_inputs)
+            INPUT_CACHE.put(self.package._inputs_key(), self.inputs)
+            missing = range(len(self.fragments))
+
+        keys = self.package._image_keys(self.fragments, self.renderer,
+                                        self.inputs)
+        for i in missing:
+            if self.images[i] is not None:
+                IMAGE_CACHE.put(keys[i], self.images[i])
+        return self.package.assemble(self.images)
+
+
+@lru_cache(maxsize=None)
+def load_symbol_database():
+    return util.load_json('data/symbols.json', UnrenderedSymbolDatabase)
+
+
+__getattr__ = util.lazy_globals(globals(), {
+    'UNICODE_SYMBOLS': load_unicode_symbols,
+    'SYMBOL_DATABASE': load_symbol_database,
+})
 
 
 class SymbolCommandArgument:
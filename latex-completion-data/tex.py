@@ -1,13 +1,19 @@
 from pathlib import Path
 from enum import Enum
 from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
-from subprocess import DEVNULL, TimeoutExpired
+from subprocess import DEVNULL, PIPE, TimeoutExpired
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
+from functools import lru_cache
+import cache
 import util
 import logging
-from tqdm import tqdm
+import math
+import os
+import signal
+import threading
 
 
 @dataclass
@@ -16,7 +22,18 @@ class Primitives:
     environments: List[str]
 
 
-KERNEL_PRIMITIVES = util.load_json('data/kernel.json', Primitives)
+@lru_cache(maxsize=None)
+def load_kernel_primitives():
+    return util.load_json('data/kernel.json', Primitives)
+
+
+@dataclass
+class ResourceLimits:
+    memory: Optional[int] = 4 * 1024 ** 3
+    cpu: Optional[int] = None
+
+
+LIMITS = ResourceLimits()
 
 
 class Format(Enum):
@@ -35,9 +52,35 @@ class Format(Enum):
             return Format.LATEX
 
 
+@lru_cache(maxsize=None)
+def engine_version(fmt):
+    cmd = [fmt.value, '--version']
+    output = subprocess.run(cmd, capture_output=True, text=True).stdout
+    return output.splitlines()[0] if output else ''
+
+
+FORMAT_ENGINES = {
+    Format.LATEX: ['pdftex'],
+    Format.LUALATEX: ['luahbtex', 'luatex'],
+    Format.XELATEX: ['xetex'],
+}
+
+
+@lru_cache(maxsize=None)
+def format_file(fmt):
+    """Returns the path of the format file loaded for fmt, or None if kpsewhich cannot find it."""
+    for engine in FORMAT_ENGINES[fmt]:
+        cmd = ['kpsewhich', f'-engine={engine}', f'{fmt.value}.fmt']
+        output = subprocess.run(cmd, capture_output=True, text=True).stdout
+        if output.strip():
+            return Path(output.splitlines()[0])
+    return None
+
+
 class CompilationResult:
-    def __init__(self, tmpdir):
+    def __init__(self, tmpdir, returncode=0):
         self.tmpdir = tmpdir
+        self.returncode = returncode
 
     def find(self, ext):
         return Path(self.tmpdir.name) / 'code.{}'.format(ext)
@@ -45,18 +88,78 @@ class CompilationResult:
     def read_log(self):
         return self.find('log').read_text(errors='replace')
 
+    def read_inputs(self):
+        """Returns the absolute paths of the files the engine read.
+
+        Files in the job's own directory and format files are left out: the
+        former are gone once the result is cleaned up, and callers fingerprint
+        the format separately, which may itself live in a temporary directory.
+        """
+        inputs = {}
+        tmpdir = Path(self.tmpdir.name)
+        try:
+            with self.find('fls').open(errors='replace') as f:
+                for line in f:
+                    if line.startswith('INPUT '):
+                        path = Path(line[len('INPUT '):].rstrip('\n'))
+                        if path.is_absolute() and path.suffix != '.fmt' \
+                                and tmpdir not in path.parents:
+                            inputs[str(path)] = None
+        except FileNotFoundError:
+            pass
+        return list(inputs)
+
+
+def _spawn(args, cwd, timeout=None, stdin=DEVNULL):
+    memory = LIMITS.memory
+    cpu = LIMITS.cpu or (math.ceil(timeout) if timeout else None)
+
+    # The limits are applied by a shell that then replaces itself with the
+    # engine; preexec_fn is not safe while other threads are running.
+    limits = []
+    if memory:
+        limits.append(f'ulimit -v {memory // 1024}')
+    if cpu:
+        limits.append(f'ulimit -t {cpu}')
+    if limits:
+        script = '; '.join(limits + ['exec "$@"'])
+        args = ['sh', '-c', script, 'sh', *args]
 
-def compile(code, fmt=Format.LATEX, timeout=10, pdf=False):
+    return subprocess.Popen(args, cwd=cwd, stdin=stdin, stdout=DEVNULL, stderr=DEVNULL,
+                            text=True, start_new_session=True)
+
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def _wait(process, timeout):
+    try:
+        return process.wait(timeout)
+    except TimeoutExpired as error:
+        _kill(process)
+        raise error
+
+
+def compile(code, fmt=Format.LATEX, timeout=10, pdf=False, fmt_file=None, recorder=False):
     tmpdir = TemporaryDirectory()
     (Path(tmpdir.name) / 'code.tex').write_text(code)
 
     flags = ['-interaction=batchmode', '-shell-escape']
     if pdf:
         flags.append('-output-format=pdf')
+    if fmt_file:
+        flags.append(f'-fmt={fmt_file}')
+    if recorder:
+        flags.append('-recorder')
     try:
-        subprocess.run([fmt.value, *flags, 'code.tex'], cwd=tmpdir.name, timeout=timeout,
-                       stdout=DEVNULL, stderr=DEVNULL)
-        return CompilationResult(tmpdir)
+        process = _spawn([fmt.value, *flags, 'code.tex'], tmpdir.name, timeout)
+        returncode = _wait(process, timeout)
+        return CompilationResult(tmpdir, returncode)
     except TimeoutExpired as error:
         try:
             tmpdir.cleanup()
@@ -66,6 +169,94 @@ def compile(code, fmt=Format.LATEX, timeout=10, pdf=False):
         raise error
 
 
+class Engine:
+    """A TeX process that has already started and waits for one line of input on stdin."""
+
+    def __init__(self, code, fmt=Format.LATEX, fmt_file=None, timeout=10, recorder=False):
+        self.tmpdir = TemporaryDirectory()
+        (Path(self.tmpdir.name) / 'code.tex').write_text(code)
+
+        flags = ['-interaction=batchmode', '-shell-escape']
+        if fmt_file:
+            flags.append(f'-fmt={fmt_file}')
+        if recorder:
+            flags.append('-recorder')
+        self.process = _spawn([fmt.value, *flags, 'code.tex'], self.tmpdir.name,
+                              timeout, stdin=PIPE)
+
+    def run(self, line, timeout=10):
+        try:
+            self.process.stdin.write(line + '\n')
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        try:
+            returncode = _wait(self.process, timeout)
+            return CompilationResult(self.tmpdir, returncode)
+        except TimeoutExpired as error:
+            self.close()
+            raise error
+
+    def close(self):
+        _kill(self.process)
+        try:
+            self.tmpdir.cleanup()
+        except OSError:
+            pass
+
+
+class EnginePool:
+    """Keeps one started engine per thread so that the next job does not wait for startup.
+
+    The engine for the next job starts while the current one runs, so every
+    thread has two TeX processes; callers have to account for them.
+    """
+
+    def __init__(self, code, fmt=Format.LATEX, fmt_file=None, recorder=False):
+        self.code = code
+        self.fmt = fmt
+        self.fmt_file = fmt_file
+        self.recorder = recorder
+        self.lock = threading.Lock()
+        self.idle = []
+        self.local = threading.local()
+
+    def _spawn(self):
+        engine = Engine(self.code, self.fmt, self.fmt_file,
+                        recorder=self.recorder)
+        with self.lock:
+            self.idle.append(engine)
+        return engine
+
+    def run(self, line, timeout=10):
+        engine = getattr(self.local, 'engine', None) or self._spawn()
+        with self.lock:
+            self.idle.remove(engine)
+
+        self.local.engine = self._spawn()
+        return engine.run(line, timeout)
+
+    def close(self):
+        with self.lock:
+            engines, self.idle = self.idle, []
+        for engine in engines:
+            engine.close()
+
+
+def dump_format(code, fmt=Format.LATEX, timeout=60, recorder=False):
+    tmpdir = TemporaryDirectory()
+    (Path(tmpdir.name) / 'code.tex').write_text(code)
+
+    flags = ['-ini', '-interaction=batchmode', f'&{fmt.value}']
+    if recorder:
+        flags.append('-recorder')
+    process = _spawn([fmt.value, *flags, 'code.tex'], tmpdir.name, timeout)
+    returncode = _wait(process, timeout)
+    return CompilationResult(tmpdir, returncode)
+
+
+RESOLVER_CACHE = cache.Cache('resolver')
 TEX_DIR_PATTERNS = ['tex/plain/', 'tex/generic/', 'tex/latex/', 'tex/platex/',
                     'tex/luatex/', 'tex/lualatex/', 'tex/xetex/', 'tex/xelatex/']
 
@@ -74,26 +265,109 @@ def find_root_dir():
     output = subprocess.run(cmd, capture_output=True, text=True).stdout
     return Path(output.splitlines()[0])
 
-class FileResolver:
-    def __init__(self):
-        root_dir = find_root_dir()
-        self.files_by_name = {x.name: x for x in self._read_database(root_dir)}
+def find_tree_dirs():
+    """Returns the existing TEXMF trees in kpathsea precedence order."""
+    cmd = ['kpsewhich', '--expand-braces', '$TEXMF']
+    output = subprocess.run(cmd, capture_output=True, text=True).stdout
+    tree_dirs = []
+    for entry in output.strip().split(os.pathsep):
+        # !! only tells kpathsea not to search the disk outside of ls-R
+        tree_dir = Path(entry.lstrip('!'))
+        if entry and tree_dir not in tree_dirs and tree_dir.is_dir():
+            tree_dirs.append(tree_dir)
+    return tree_dirs
+
 
+def _has_suffix(name):
+    # Same rule as Path.suffix
+    index = name.rfind('.')
+    return 0 < index < len(name) - 1
 
 
-    def _read_database(self, root_dir):
-        db_file = root_dir / 'ls-R'
-        lines = list(x for x in db_file.read_text().splitlines()
-                     if x and not x.isspace() and not x.startswith('%'))
+def _read_database(root_dir, db_file):
+    paths_by_name = {}
+    current_dir = None
+    with db_file.open() as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line or line.isspace() or line.startswith('%'):
+                continue
 
-        current_dir = None
-        for line in tqdm(lines, desc='Loading resolver'):
             if line.endswith(':'):
-                current_dir = root_dir / line[:-1]
-            elif any(pat in current_dir.as_posix() for pat in TEX_DIR_PATTERNS):
-                file = current_dir / (line)
-                if file.suffix:
-                    yield file
+                current_dir = (root_dir / line[:-1]).as_posix()
+                if not any(pat in current_dir for pat in TEX_DIR_PATTERNS):
+                    current_dir = None
+            elif current_dir is not None and _has_suffix(line):
+                paths_by_name[line] = current_dir + '/' + line
+    return paths_by_name
+
+
+def _walk_tree(root_dir):
+    paths_by_name = {}
+    for current_dir, _, names in os.walk(str(root_dir)):
+        current_dir = Path(current_dir).as_posix()
+        if any(pat in current_dir for pat in TEX_DIR_PATTERNS):
+            for name in filter(_has_suffix, names):
+                paths_by_name[name] = current_dir + '/' + name
+    return paths_by_name
+
+
+def load_tree_index(root_dir):
+    """Maps file names to paths for one TEXMF tree, using its ls-R database if it has one.
+
+    Indexes read from ls-R are cached until ls-R changes.
+    """
+    db_file = root_dir / 'ls-R'
+    if not db_file.exists():
+        return _walk_tree(root_dir)
+
+    stat = db_file.stat()
+    key = cache.hash_text(str(db_file), str(stat.st_size),
+                          str(stat.st_mtime_ns), *TEX_DIR_PATTERNS)
+    index = RESOLVER_CACHE.get(key)
+    if index is None:
+        index = _read_database(root_dir, db_file)
+        RESOLVER_CACHE.put(key, index)
+    return index
+
+
+class FileResolver:
+    """Maps file names to their paths in the TeX directories of all TEXMF trees.
+
+    Like kpathsea, a file in an earlier tree shadows files of the same name in
+    later trees; the hidden paths are kept in shadowed_by_name. The index
+    keeps plain strings.
+    """
+
+    def __init__(self, tree_dirs=None):
+        tree_dirs = find_tree_dirs() if tree_dirs is None else tree_dirs
+        # Parsing is serialized by the GIL; the threads only overlap waiting
+        # for the disk, mostly while walking trees without ls-R.
+        with ThreadPoolExecutor(len(tree_dirs) or 1) as executor:
+            indexes = list(executor.map(load_tree_index, tree_dirs))
+
+        self.paths_by_name = {}
+        self.shadowed_by_name = {}
+        for index in indexes:
+            for name, path in index.items():
+                if name in self.paths_by_name:
+                    self.shadowed_by_name.setdefault(name, []).append(path)
+                else:
+                    self.paths_by_name[name] = path
+        if self.shadowed_by_name:
+            logging.info(f'{len(self.shadowed_by_name)} files are shadowed by another TEXMF tree')
+
+    def resolve(self, name):
+        path = self.paths_by_name.get(name)
+        return Path(path) if path is not None else None
+
+
+@lru_cache(maxsize=None)
+def load_file_resolver():
+    return FileResolver()
 
 
-FILE_RESOLVER = FileResolver()
+__getattr__ = util.lazy_globals(globals(), {
+    'KERNEL_PRIMITIVES': load_kernel_primitives,
+    'FILE_RESOLVER': load_file_resolver,
+})
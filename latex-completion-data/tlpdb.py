@@ -36,7 +36,12 @@
 # Python 2.x and 3.x handle strings differently.  In python 3.x, all strings are unicode instances.  That means they
 # don't have the decode() method.  As a hack, I'm testing the version number and using decode() only if the python
 # version number is less than 3.
+import hashlib
 import io
+import mmap
+import os
+import posixpath
+import sqlite3
 import sys
 python_major_version = sys.version_info[0]
 
@@ -380,6 +385,208 @@ def packages_from_tlpdb(flat_tlpdb, allow_partial=False):
     return all_packages, index_map
 
 
+DEFAULT_RECORD_FIELDS = ("name", "revision", "shortdesc", "longdesc", "runfiles")
+
+
+class PackageRecord(object):
+    """Lightweight TeX Live package with only the fields selected when reading.
+
+    Fields that were not selected keep their default value.
+
+    """
+    __slots__ = ("name", "category", "revision", "shortdesc", "longdesc",
+                 "depends", "runfiles")
+
+    def __init__(self, name):
+        self.name = name
+        self.category = None
+        self.revision = None
+        self.shortdesc = None
+        self.longdesc = None
+        self.depends = []
+        self.runfiles = []
+
+    def __repr__(self):
+        return "PackageRecord(%r, revision=%r)" % (self.name, self.revision)
+
+
+def read_packages(flat_tlpdb, fields=DEFAULT_RECORD_FIELDS):
+    """Yields a PackageRecord for every package in a tlpdb.
+
+    Arguments:
+    flat_tlpdb -- A binary file or mmap of the tlpdb
+    fields -- The fields to keep; any of "category", "revision", "shortdesc",
+    "longdesc", "depends" and "runfiles". The name is always kept.
+
+    Unlike packages_from_tlpdb, this reads the file line by line, only decodes
+    the selected values and never parses attribute lines. The values are the
+    same as the ones of the corresponding TLPackage attributes.
+
+    """
+    keep = frozenset(fields)
+    keep_runfiles = "runfiles" in keep
+    package = None
+    longdesc = None
+    key = None
+
+    for line in iter(flat_tlpdb.readline, b""):
+        line = line.rstrip(b"\r\n")
+
+        if not line:
+            if package is not None:
+                if longdesc is not None:
+                    package.longdesc = "".join(longdesc)
+                yield package
+            package = None
+            longdesc = None
+            key = None
+        elif line[0] == 0x20:
+            # continuation of the last key, e.g. a list of files
+            if key == "runfiles" and keep_runfiles:
+                package.runfiles.append(line[1:].decode("utf-8"))
+        elif line[0] == 0x23 or (package is None and line.startswith(b"location-url\t")):
+            continue
+        else:
+            raw_key, ignored, value = line.partition(b" ")
+            key = raw_key.decode("ascii")
+            if key == "name":
+                package = PackageRecord(value.decode("utf-8"))
+            elif key == "depend":
+                if "depends" in keep:
+                    package.depends.append(value.decode("utf-8"))
+            elif key not in keep:
+                continue
+            elif key == "revision":
+                package.revision = int(value)
+            elif key == "shortdesc":
+                package.shortdesc = value.decode("utf-8")
+            elif key == "longdesc":
+                if longdesc is None:
+                    longdesc = []
+                longdesc.append(" " + value.decode("utf-8"))
+            elif key == "category":
+                package.category = value.decode("utf-8")
+
+    if package is not None:
+        if longdesc is not None:
+            package.longdesc = "".join(longdesc)
+        yield package
+
+
+class PackageStore(object):
+    """Indexed cache of the package records of a tlpdb.
+
+    The records are kept in an SQLite file at cache_path, which is rebuilt
+    when the tlpdb changes. A changed size or mtime alone only triggers a
+    comparison of the content hash.
+
+    """
+    SCHEMA = """
+        CREATE TABLE source (stamp TEXT, hash TEXT);
+        CREATE TABLE packages (id INTEGER PRIMARY KEY, name TEXT NOT NULL, revision INTEGER,
+                               shortdesc TEXT, longdesc TEXT);
+        CREATE TABLE runfiles (package_id INTEGER NOT NULL, position INTEGER NOT NULL,
+                               path TEXT NOT NULL, basename TEXT NOT NULL, extension TEXT NOT NULL);
+    """
+    INDEXES = """
+        CREATE UNIQUE INDEX packages_name ON packages (name);
+        CREATE INDEX runfiles_basename ON runfiles (basename);
+    """
+
+    def __init__(self, tlpdb_path, cache_path):
+        self.tlpdb_path = tlpdb_path
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(cache_path), check_same_thread=False)
+        stamp = self._stamp()
+        source = self._read_source()
+        if source is None or source[0] != stamp:
+            digest = self._hash()
+            if source is not None and source[1] == digest:
+                with self.conn:
+                    self.conn.execute("UPDATE source SET stamp = ?", (stamp,))
+            else:
+                self._rebuild(stamp, digest)
+
+    def _stamp(self):
+        stat = os.stat(str(self.tlpdb_path))
+        return "%d:%d" % (stat.st_size, stat.st_mtime_ns)
+
+    def _hash(self):
+        digest = hashlib.sha256()
+        with open(str(self.tlpdb_path), "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _read_source(self):
+        try:
+            return self.conn.execute("SELECT stamp, hash FROM source").fetchone()
+        except sqlite3.DatabaseError:
+            return None
+
+    def _rebuild(self, stamp, digest):
+        with self.conn:
+            for table in ("source", "packages", "runfiles"):
+                self.conn.execute("DROP TABLE IF EXISTS %s" % table)
+            self.conn.executescript(self.SCHEMA)
+            with open(str(self.tlpdb_path), "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for package_id, package in enumerate(read_packages(data)):
+                    self.conn.execute("INSERT INTO packages VALUES (?,?,?,?,?)",
+                                      (package_id, package.name, package.revision,
+                                       package.shortdesc, package.longdesc))
+                    self.conn.executemany("INSERT INTO runfiles VALUES (?,?,?,?,?)",
+                                          ((package_id, position, path,
+                                            posixpath.basename(path),
+                                            posixpath.splitext(path)[1])
+                                           for position, path in enumerate(package.runfiles)))
+            self.conn.executescript(self.INDEXES)
+            self.conn.execute("INSERT INTO source VALUES (?,?)", (stamp, digest))
+
+    def packages(self):
+        """Returns the PackageRecord of every package in tlpdb order."""
+        packages = []
+        for name, revision, shortdesc, longdesc in self.conn.execute(
+                "SELECT name, revision, shortdesc, longdesc FROM packages ORDER BY id"):
+            package = PackageRecord(name)
+            package.revision = revision
+            package.shortdesc = shortdesc
+            package.longdesc = longdesc
+            packages.append(package)
+
+        for package_id, path in self.conn.execute(
+                "SELECT package_id, path FROM runfiles ORDER BY package_id, position"):
+            packages[package_id].runfiles.append(path)
+        return packages
+
+    def revision(self, name):
+        row = self.conn.execute(
+            "SELECT revision FROM packages WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def revisions(self):
+        return dict(self.conn.execute("SELECT name, revision FROM packages"))
+
+    def find_owner(self, file_name):
+        """Returns the name of the first package with a runfile called file_name."""
+        row = self.conn.execute(
+            "SELECT packages.name FROM runfiles JOIN packages ON packages.id = runfiles.package_id "
+            "WHERE runfiles.basename = ? ORDER BY runfiles.package_id LIMIT 1", (file_name,)).fetchone()
+        return row[0] if row else None
+
+    def owners(self, extensions):
+        """Maps the names of all runfiles with one of the given extensions to the first package that contains them."""
+        owners = {}
+        placeholders = ",".join("?" * len(extensions))
+        for basename, name in self.conn.execute(
+                "SELECT runfiles.basename, packages.name FROM runfiles "
+                "JOIN packages ON packages.id = runfiles.package_id "
+                "WHERE runfiles.extension IN (%s) "
+                "ORDER BY runfiles.package_id, runfiles.position" % placeholders, tuple(extensions)):
+            owners.setdefault(basename, name)
+        return owners
+
+
 def _save_as_sqlite(packages, absolute_path):
     """Save a list of packages as an SQLite3 binary file.
 
@@ -1,12 +1,69 @@
-import jsons
 from pathlib import Path
 from tqdm import tqdm
+import cache
+import dataclasses
 
+DATA_CACHE = cache.PickleCache('data')
 
-def load_json(name, cls):
+
+def load_data(name, load, *key):
+    """Calls load with the path of a data file and caches the result until the file changes."""
     path = Path(__file__).parent / name
-    json = path.read_text()
-    return jsons.loads(json, cls, key_transformer=jsons.KEY_TRANSFORMER_SNAKECASE)
+    key = cache.hash_text(name, cache.hash_file(path), *key)
+    value = DATA_CACHE.get(key)
+    if value is None:
+        value = load(path)
+        DATA_CACHE.put(key, value)
+    return value
+
+
+def schema_fingerprint(cls):
+    """Lists the fields of a dataclass and of all dataclasses reachable from its field types.
+
+    Pickles refer to classes by name only, so this is part of the cache key
+    to keep objects with other fields from being loaded.
+    """
+    schema = {}
+    pending = [cls]
+    while pending:
+        tp = pending.pop()
+        if dataclasses.is_dataclass(tp):
+            name = f'{tp.__module__}.{tp.__qualname__}'
+            if name in schema:
+                continue
+            fields = dataclasses.fields(tp)
+            schema[name] = [(field.name, str(field.type)) for field in fields]
+            pending.extend(field.type for field in fields)
+        else:
+            pending.extend(getattr(tp, '__args__', None) or ())
+    return str(sorted(schema.items()))
+
+
+def load_json(name, cls):
+    def load(path):
+        # jsons is slow to import and only needed when the cache is cold.
+        import jsons
+        return jsons.loads(path.read_text(), cls,
+                           key_transformer=jsons.KEY_TRANSFORMER_SNAKECASE)
+
+    return load_data(name, load, schema_fingerprint(cls))
+
+
+def lazy_globals(namespace, factories):
+    """Returns a module __getattr__ that creates the given globals on first access.
+
+    Code inside the module has to call the factories instead, since global
+    lookups within a module do not fall back to __getattr__.
+    """
+    def __getattr__(name):
+        factory = factories.get(name)
+        if factory is None:
+            raise AttributeError(
+                f"module {namespace['__name__']!r} has no attribute {name!r}")
+        namespace[name] = factory()
+        return namespace[name]
+
+    return __getattr__
 
 
 def with_progress(desc, total, f):